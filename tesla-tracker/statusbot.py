@@ -8,6 +8,8 @@ import json
 import requests
 import os
 import re
+import sqlite3
+from collections import deque
 from dotenv import load_dotenv
 load_dotenv()
 print(f"[DEBUG] TELEGRAM_CHAT_ID at startup: {os.getenv('TELEGRAM_CHAT_ID')}", flush=True)
@@ -28,24 +30,134 @@ TESLA_TOKEN_CACHE = os.getenv("TESLA_TOKEN_CACHE")
 CAR_LABELS = [s.strip() for s in os.getenv("CAR_LABELS", "Car 1,Car 2").split(",")]
 CAR_COLORS = [s.strip() for s in os.getenv("CAR_COLORS", "🔵,⚪").split(",")]
 
+STATE_DB_FILE = os.getenv("STATE_DB_FILE", "statusbot_state.db")
+POLL_TIMEOUT = int(os.getenv("TELEGRAM_POLL_TIMEOUT", 25))  # getUpdates long-poll seconds
+DEDUP_WINDOW = 1000  # Most recent update_ids remembered across restarts
+MAX_UPDATE_ATTEMPTS = 3  # Attempts per update (first try plus retries) before it is skipped
+
 pending_actions = {}
 
-# --- Persistent update_id storage ---
-LAST_UPDATE_ID_FILE = "last_update_id.txt"
+# --- Persistent state store (SQLite) ---
+# Offsets, allowed users, pending adds/requests/actions and the recent
+# update_id window all live in one SQLite database. Each getUpdates batch is
+# one transaction, committed together with the new offset, so a crash replays
+# at most the batch in flight. Every update runs inside a savepoint: a failed
+# update has its writes rolled back and is fetched again on the next poll, up
+# to MAX_UPDATE_ATTEMPTS attempts, while the rest of the batch carries on.
+LAST_UPDATE_ID_FILE = "last_update_id.txt"  # Legacy, imported on first run
+ALLOWED_USERS_FILE = "allowed_users.json"   # Legacy, imported on first run
+PENDING_ADDS_FILE = "pending_adds.json"     # Legacy, imported on first run
 
-def load_last_update_id():
-    try:
-        with open(LAST_UPDATE_ID_FILE, "r") as f:
-            return int(f.read().strip())
-    except Exception:
-        return None
+def open_state_store(path=STATE_DB_FILE):
+    conn = sqlite3.connect(path, isolation_level=None)  # Transactions are managed explicitly
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS processed_updates (update_id INTEGER PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS allowed_users (user_id INTEGER PRIMARY KEY NOT NULL);
+        CREATE TABLE IF NOT EXISTS pending_adds (username TEXT PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS pending_requests (user_id INTEGER PRIMARY KEY NOT NULL, full_name TEXT, username TEXT);
+        CREATE TABLE IF NOT EXISTS pending_actions (user_id INTEGER PRIMARY KEY NOT NULL, action TEXT);
+    """)
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_imported'").fetchone() is None:
+        import_legacy_state(conn)
+    return conn
 
-def save_last_update_id(update_id):
+def import_legacy_state(conn):
+    # All-or-nothing: if any legacy file is unreadable, nothing is imported and
+    # the import is attempted again on the next start.
+    imported = []
+    conn.execute("BEGIN")
     try:
-        with open(LAST_UPDATE_ID_FILE, "w") as f:
-            f.write(str(update_id))
+        if os.path.exists(LAST_UPDATE_ID_FILE):
+            with open(LAST_UPDATE_ID_FILE, "r") as f:
+                save_last_update_id(conn, int(f.read().strip()))
+            imported.append(LAST_UPDATE_ID_FILE)
+        if os.path.exists(ALLOWED_USERS_FILE):
+            with open(ALLOWED_USERS_FILE, "r") as f:
+                for user_id in json.load(f):
+                    add_allowed_user(conn, int(user_id))
+            imported.append(ALLOWED_USERS_FILE)
+        if os.path.exists(PENDING_ADDS_FILE):
+            with open(PENDING_ADDS_FILE, "r") as f:
+                for pending_username in json.load(f):
+                    add_pending_add(conn, pending_username)
+            imported.append(PENDING_ADDS_FILE)
     except Exception as e:
-        print(f"[ERROR] Could not save last_update_id: {e}", flush=True)
+        conn.execute("ROLLBACK")
+        print(f"[ERROR] Could not import legacy state files, will retry on next start: {e}", flush=True)
+        return
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('legacy_imported', '1')")
+    conn.execute("COMMIT")
+    if imported:
+        print(f"[DEBUG] Imported legacy state files into state store: {', '.join(imported)}", flush=True)
+
+def load_last_update_id(conn):
+    row = conn.execute("SELECT value FROM meta WHERE key = 'last_update_id'").fetchone()
+    return int(row[0]) if row else None
+
+def save_last_update_id(conn, update_id):
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_update_id', ?)", (str(update_id),))
+    conn.execute(
+        "DELETE FROM processed_updates WHERE update_id <= "
+        "(SELECT update_id FROM processed_updates ORDER BY update_id DESC LIMIT 1 OFFSET ?)",
+        (DEDUP_WINDOW,)
+    )
+
+def load_processed_update_ids(conn):
+    rows = conn.execute(
+        "SELECT update_id FROM processed_updates ORDER BY update_id DESC LIMIT ?", (DEDUP_WINDOW,)
+    ).fetchall()
+    return deque((r[0] for r in reversed(rows)), maxlen=DEDUP_WINDOW)
+
+def mark_update_processed(conn, update_id):
+    conn.execute("INSERT OR IGNORE INTO processed_updates (update_id) VALUES (?)", (update_id,))
+
+def load_allowed_users(conn):
+    return {r[0] for r in conn.execute("SELECT user_id FROM allowed_users")}
+
+def add_allowed_user(conn, user_id):
+    conn.execute("INSERT OR IGNORE INTO allowed_users (user_id) VALUES (?)", (user_id,))
+
+def load_pending_adds(conn):
+    return {r[0]: True for r in conn.execute("SELECT username FROM pending_adds")}
+
+def add_pending_add(conn, pending_username):
+    conn.execute("INSERT OR IGNORE INTO pending_adds (username) VALUES (?)", (pending_username.lower(),))
+
+def remove_pending_add(conn, pending_username):
+    conn.execute("DELETE FROM pending_adds WHERE username = ?", (pending_username.lower(),))
+
+def load_pending_requests(conn):
+    return {
+        r[0]: {"full_name": r[1], "username": r[2]}
+        for r in conn.execute("SELECT user_id, full_name, username FROM pending_requests")
+    }
+
+def add_pending_request(conn, user_id, full_name, username):
+    conn.execute(
+        "INSERT OR REPLACE INTO pending_requests (user_id, full_name, username) VALUES (?, ?, ?)",
+        (user_id, full_name, username)
+    )
+
+def remove_pending_request(conn, user_id):
+    conn.execute("DELETE FROM pending_requests WHERE user_id = ?", (user_id,))
+
+def load_pending_actions(conn):
+    return {r[0]: r[1] for r in conn.execute("SELECT user_id, action FROM pending_actions")}
+
+def set_pending_action(conn, user_id, action):
+    conn.execute("INSERT OR REPLACE INTO pending_actions (user_id, action) VALUES (?, ?)", (user_id, action))
+
+def remove_pending_action(conn, user_id):
+    conn.execute("DELETE FROM pending_actions WHERE user_id = ?", (user_id,))
+
+def load_user_state(conn):
+    # Refreshes the module-level pending_actions and returns the other in-memory copies
+    pending_actions.clear()
+    pending_actions.update(load_pending_actions(conn))
+    return load_allowed_users(conn), load_pending_adds(conn), load_pending_requests(conn)
 
 # --- Telegram send helpers ---
 def send_telegram_message(message, markdown=False):
@@ -58,7 +170,7 @@ def send_telegram_message(message, markdown=False):
         payload["parse_mode"] = "Markdown"
     print(f"[DEBUG] Telegram payload: {payload}", flush=True)
     try:
-        resp = requests.post(url, data=payload)
+        resp = requests.post(url, data=payload, timeout=10)
         if resp.status_code != 200:
             print(f"[ERROR] Failed to send Telegram message: {resp.status_code} {resp.text}", flush=True)
         else:
@@ -73,7 +185,10 @@ def send_telegram_location(lat, lon):
         "latitude": lat,
         "longitude": lon
     }
-    requests.post(url, data=payload)
+    try:
+        requests.post(url, data=payload, timeout=10)
+    except Exception as e:
+        print(f"[ERROR] Exception sending Telegram location: {e}", flush=True)
 
 # --- Helper Formatting Functions ---
 def fmt_bool(val):
@@ -128,60 +243,42 @@ def perform_tesla_action(car_index, action):
     except Exception as e:
         return False, f"Tesla API error: {e}"
 
-# --- Allowed users management ---
-ALLOWED_USERS_FILE = "allowed_users.json"
-PENDING_ADDS_FILE = "pending_adds.json"
-
-def load_allowed_users():
-    try:
-        with open(ALLOWED_USERS_FILE, "r") as f:
-            return set(json.load(f))
-    except Exception:
-        return set()
-
-def save_allowed_users(users):
-    try:
-        with open(ALLOWED_USERS_FILE, "w") as f:
-            json.dump(list(users), f)
-    except Exception as e:
-        print(f"[ERROR] Could not save allowed users: {e}", flush=True)
-
-def load_pending_adds():
-    try:
-        with open(PENDING_ADDS_FILE, "r") as f:
-            return json.load(f)
-    except Exception:
-        return {}
-
-def save_pending_adds(pending):
-    try:
-        with open(PENDING_ADDS_FILE, "w") as f:
-            json.dump(pending, f)
-    except Exception as e:
-        print(f"[ERROR] Could not save pending adds: {e}", flush=True)
-
 # --- Main polling loop ---
 def poll_telegram_commands():
     print("[DEBUG] poll_telegram_commands loop started", flush=True)
-    last_update_id = load_last_update_id()
-    processed_update_ids = set()
-    allowed_users = load_allowed_users()
-    pending_adds = load_pending_adds()
-    pending_requests = {}  # user_id -> {name, username}
+    conn = open_state_store()
+    last_update_id = load_last_update_id(conn)
+    recent_update_ids = load_processed_update_ids(conn)
+    processed_update_ids = set(recent_update_ids)
+    # pending_requests: user_id -> {name, username}
+    allowed_users, pending_adds, pending_requests = load_user_state(conn)
+    failed_attempts = {}  # update_id -> number of failed attempts
     ADMIN_USER_ID = int(os.getenv("TELEGRAM_ADMIN_USER_ID", "6269997804"))  # Set your own user ID here
     while True:
         print("[DEBUG] poll_telegram_commands loop alive", flush=True)
         try:
             url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/getUpdates"
+            params = {"timeout": POLL_TIMEOUT}
             if last_update_id is not None:
-                url += f"?offset={last_update_id + 1}"
-            response = requests.get(url)
-            updates = response.json().get('result', [])
+                params["offset"] = last_update_id + 1
+            response = requests.get(url, params=params, timeout=POLL_TIMEOUT + 10)
+            result = response.json()
+            if not result.get('ok'):
+                print(f"[ERROR] getUpdates failed: {result}", flush=True)
+                time.sleep(30)
+                continue
+            updates = result.get('result', [])
+            if updates:
+                conn.execute("BEGIN")
+            retry_from = None  # First update_id of this batch that must be fetched again
             for update in updates:
                 update_id = update['update_id']
                 if update_id in processed_update_ids:
+                    if retry_from is None:
+                        last_update_id = update_id
                     continue
-                processed_update_ids.add(update_id)
+                failed = False
+                conn.execute("SAVEPOINT handle_update")
                 try:
                     message = update.get('message', {}).get('text', '')
                     user_id = update.get('message', {}).get('from', {}).get('id')
@@ -190,6 +287,9 @@ def poll_telegram_commands():
                     last_name = update.get('message', {}).get('from', {}).get('last_name', '')
                     full_name = f"{first_name} {last_name}".strip()
                     print(f"[DEBUG] Received message: '{message}' from user {user_id} (update: {update})", flush=True)
+                    # Ignore updates without a sender (edited_message, callback_query, my_chat_member, ...)
+                    if user_id is None:
+                        continue
 
                     # --- Handle admin approval for pending requests ---
                     if user_id == ADMIN_USER_ID and message.lower().startswith("yes "):
@@ -200,13 +300,17 @@ def poll_telegram_commands():
                             continue
                         if approve_id in pending_requests:
                             allowed_users.add(approve_id)
-                            save_allowed_users(allowed_users)
+                            add_allowed_user(conn, approve_id)
                             user_info = pending_requests.pop(approve_id)
+                            remove_pending_request(conn, approve_id)
                             send_telegram_message(f"Access granted to {user_info['full_name']} (@{user_info['username']}) [{approve_id}].")
                             # Notify the newly approved user
                             notify_url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
                             notify_payload = {"chat_id": approve_id, "text": "You have been approved to use Tesla Tracker!"}
-                            requests.post(notify_url, data=notify_payload)
+                            try:
+                                requests.post(notify_url, data=notify_payload, timeout=10)
+                            except Exception as e:
+                                print(f"[ERROR] Could not notify approved user {approve_id}: {e}", flush=True)
                         else:
                             send_telegram_message(f"No pending request for user_id {approve_id}.")
                         continue
@@ -217,7 +321,7 @@ def poll_telegram_commands():
                         if match:
                             pending_username = match.group(1)
                             pending_adds[pending_username.lower()] = True
-                            save_pending_adds(pending_adds)
+                            add_pending_add(conn, pending_username)
                             send_telegram_message(f"Ask @{pending_username} to send me any message to complete registration.")
                         else:
                             send_telegram_message("Usage: /add @username (ask the user to send me any message after)")
@@ -226,9 +330,9 @@ def poll_telegram_commands():
                     # --- Handle new user registration via /add ---
                     if username and username.lower() in pending_adds:
                         allowed_users.add(user_id)
-                        save_allowed_users(allowed_users)
+                        add_allowed_user(conn, user_id)
                         del pending_adds[username.lower()]
-                        save_pending_adds(pending_adds)
+                        remove_pending_add(conn, username)
                         send_telegram_message(f"Welcome, @{username}! You now have access to Tesla Tracker.")
                         # Notify admin
                         send_telegram_message(f"@{username} ({user_id}) has been added to allowed users.", markdown=False)
@@ -239,6 +343,7 @@ def poll_telegram_commands():
                         # Notify the admin of the access request
                         if user_id not in pending_requests:
                             pending_requests[user_id] = {"full_name": full_name, "username": username or "(none)"}
+                            add_pending_request(conn, user_id, full_name, username or "(none)")
                             send_telegram_message(f"User {full_name} (@{username or 'none'}) [{user_id}] has requested access. Reply with 'yes {user_id}' to approve.")
                         # Notify the user
                         send_telegram_message("You are not authorized to use this bot. The admin has been notified of your request.")
@@ -269,6 +374,7 @@ def poll_telegram_commands():
                             finally:
                                 if user_id in pending_actions:
                                     del pending_actions[user_id]
+                                    remove_pending_action(conn, user_id)
                             continue
                         else:
                             send_telegram_message("Please reply with 1 for Car 1 or 2 for Car 2.")
@@ -331,7 +437,7 @@ def poll_telegram_commands():
                                 send_telegram_message(status_message, markdown=True)
                             except Exception as e:
                                 send_telegram_message(f"Could not load status: {e}")
-                            return
+                            continue
                     # --- Direct close commands ---
                     elif message.startswith("/close") and len(message) > 6 and message[6:].isdigit():
                         car_index = int(message[6:]) - 1
@@ -350,7 +456,7 @@ def poll_telegram_commands():
                                 send_telegram_message(status_message, markdown=True)
                             except Exception as e:
                                 send_telegram_message(f"Could not load status: {e}")
-                            return
+                            continue
                     # --- Direct sentry commands ---
                     elif message.startswith("/sentry") and len(message) > 7 and message[7:].isdigit():
                         car_index = int(message[7:]) - 1
@@ -369,18 +475,21 @@ def poll_telegram_commands():
                                 send_telegram_message(status_message, markdown=True)
                             except Exception as e:
                                 send_telegram_message(f"Could not load status: {e}")
-                            return
+                            continue
                     elif message == "/lock":
                         print("[DEBUG] Entered /lock command handler", flush=True)
                         pending_actions[user_id] = "lock"
+                        set_pending_action(conn, user_id, "lock")
                         send_telegram_message("Which car? (1 for Car 1, 2 for Car 2)")
                     elif message == "/close":
                         print("[DEBUG] Entered /close command handler", flush=True)
                         pending_actions[user_id] = "close"
+                        set_pending_action(conn, user_id, "close")
                         send_telegram_message("Which car? (1 for Car 1, 2 for Car 2)")
                     elif message == "/sentry":
                         print("[DEBUG] Entered /sentry command handler", flush=True)
                         pending_actions[user_id] = "sentry"
+                        set_pending_action(conn, user_id, "sentry")
                         send_telegram_message("Which car? (1 for Car 1, 2 for Car 2)")
                     # --- Help command ---
                     elif message == "/help":
@@ -399,12 +508,43 @@ def poll_telegram_commands():
                             "You can also use the # suffix (e.g., /lock1, /close2, /sentry1) to act on a specific car without a prompt."
                         )
                         send_telegram_message(help_message, markdown=True)
+                except Exception as e:
+                    # Drop this update's partial writes and reload the in-memory copies
+                    conn.execute("ROLLBACK TO handle_update")
+                    allowed_users, pending_adds, pending_requests = load_user_state(conn)
+                    failed_attempts[update_id] = failed_attempts.get(update_id, 0) + 1
+                    if failed_attempts[update_id] < MAX_UPDATE_ATTEMPTS:
+                        failed = True
+                        if retry_from is None:
+                            retry_from = update_id
+                        print(f"[ERROR] Update {update_id} failed (attempt {failed_attempts[update_id]}), will retry: {e}", flush=True)
+                    else:
+                        print(f"[ERROR] Skipping update {update_id} after {failed_attempts[update_id]} failed attempts: {e}", flush=True)
                 finally:
-                    last_update_id = update_id
-                    save_last_update_id(last_update_id)
+                    if not failed:
+                        failed_attempts.pop(update_id, None)
+                        mark_update_processed(conn, update_id)
+                        if len(recent_update_ids) == recent_update_ids.maxlen:
+                            processed_update_ids.discard(recent_update_ids[0])
+                        recent_update_ids.append(update_id)
+                        processed_update_ids.add(update_id)
+                        if retry_from is None:
+                            last_update_id = update_id
+                    conn.execute("RELEASE handle_update")
+            if updates:
+                if last_update_id is not None:
+                    save_last_update_id(conn, last_update_id)
+                conn.execute("COMMIT")
         except Exception as e:
             print(f"[ERROR] Exception in poll_telegram_commands: {e}", flush=True)
-        time.sleep(30)
+            # Discard the unfinished batch and resync the in-memory copies with the store
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            last_update_id = load_last_update_id(conn)
+            recent_update_ids = load_processed_update_ids(conn)
+            processed_update_ids = set(recent_update_ids)
+            allowed_users, pending_adds, pending_requests = load_user_state(conn)
+            time.sleep(30)
 
 if __name__ == "__main__":
     import teslapy
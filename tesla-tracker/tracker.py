@@ -20,10 +20,91 @@ GOOGLE_MAPS_API_KEY = os.getenv("GOOGLE_MAPS_API_KEY")
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", 60))
+ALERT_NIGHT_START = int(os.getenv("ALERT_NIGHT_START", 22))  # Hour (host timezone) sentry is expected on
+ALERT_NIGHT_END = int(os.getenv("ALERT_NIGHT_END", 6))
+LOW_TIRE_PSI = float(os.getenv("LOW_TIRE_PSI", 38))
+LOW_BATTERY_PCT = int(os.getenv("LOW_BATTERY_PCT", 20))
+ALERT_STATE_PATH = os.getenv("ALERT_STATE_PATH", '/opt/tesla-tracker/alert_state.json')
 
 # Track trips
 vehicle_states = {}
 
+# --- Alert rules ---
+# Each rule lists the sample fields it reads. A rule is only re-checked when
+# one of those fields changed since the previous sample, and it has to hold
+# for `debounce` consecutive samples before a message is sent. Once fired it
+# stays quiet until `clear` is true (defaults to `check` being false), which
+# gives hysteresis for noisy readings like tire pressure and battery. Fired
+# rules are saved to ALERT_STATE_PATH so a restart doesn't repeat them.
+TPMS_FIELDS = ('tpms_pressure_fl', 'tpms_pressure_fr', 'tpms_pressure_rl', 'tpms_pressure_rr')
+
+def is_parked(s):
+    # shift_state is None while the car is asleep or parked
+    return s['shift_state'] in (None, 'P')
+
+def min_tire_psi(s):
+    psi = [s[k] * 14.5 for k in TPMS_FIELDS if s[k]]
+    return min(psi) if psi else None
+
+ALERT_RULES = [
+    {
+        'name': 'unlocked_parked',
+        'fields': ('locked', 'shift_state'),
+        'check': lambda s: s['locked'] is False and is_parked(s),
+        'debounce': 2,
+        'message': "🔓 {label} is unlocked while parked",
+    },
+    {
+        'name': 'doors_open_parked',
+        'fields': ('doors', 'shift_state'),
+        'check': lambda s: any(s['doors'].values()) and is_parked(s),
+        'debounce': 2,
+        'message': "🚪 {label} has a door open while parked",
+    },
+    {
+        'name': 'windows_open_parked',
+        'fields': ('windows', 'shift_state'),
+        'check': lambda s: any(s['windows'].values()) and is_parked(s),
+        'debounce': 2,
+        'message': "🪟 {label} has a window open while parked",
+    },
+    {
+        'name': 'low_tire_pressure',
+        'fields': TPMS_FIELDS,
+        'check': lambda s: min_tire_psi(s) is not None and min_tire_psi(s) < LOW_TIRE_PSI,
+        'clear': lambda s: min_tire_psi(s) is None or min_tire_psi(s) >= LOW_TIRE_PSI + 2,
+        'debounce': 3,
+        'message': "🛞 {label} has low tire pressure",
+    },
+    {
+        'name': 'sentry_off_night',
+        'fields': ('sentry_mode', 'night', 'shift_state'),
+        'check': lambda s: s['night'] and s['sentry_mode'] is False and is_parked(s),
+        'debounce': 2,
+        'message': "🛡️ {label} is parked with sentry mode off",
+    },
+    {
+        'name': 'low_battery',
+        'fields': ('battery',),
+        'check': lambda s: s['battery'] is not None and s['battery'] < LOW_BATTERY_PCT,
+        'clear': lambda s: s['battery'] is None or s['battery'] >= LOW_BATTERY_PCT + 5,
+        'debounce': 1,
+        'message': "🔋 {label} battery is low ({battery}%)",
+    },
+]
+
+def index_rules_by_field(rules):
+    by_field = {}
+    for rule in rules:
+        for field in rule['fields']:
+            by_field.setdefault(field, []).append(rule)
+    return by_field
+
+ALERT_RULES_BY_FIELD = index_rules_by_field(ALERT_RULES)
+
+# vin -> {'sample': last sample, 'rules': {name: {'holds', 'streak', 'fired'}}, 'pending': set of names}
+alert_states = {}
+
 # --- Helper Functions ---
 
 def init_sheet():
@@ -48,7 +129,15 @@ def send_telegram_message(message):
         "chat_id": TELEGRAM_CHAT_ID,
         "text": message
     }
-    requests.post(url, data=payload)
+    try:
+        resp = requests.post(url, data=payload, timeout=10)
+        if resp.status_code != 200:
+            print(f"Failed to send Telegram message: {resp.status_code} {resp.text}")
+            return False
+        return True
+    except Exception as e:
+        print(f"Error sending Telegram message: {e}")
+        return False
 
 def haversine(lat1, lon1, lat2, lon2):
     # Calculate great circle distance between two points (miles)
@@ -60,6 +149,98 @@ def haversine(lat1, lon1, lat2, lon2):
     miles = 3956 * c
     return miles
 
+def is_night(now):
+    # `now` is host local time; ALERT_NIGHT_START/END follow the host timezone
+    if ALERT_NIGHT_START <= ALERT_NIGHT_END:
+        return ALERT_NIGHT_START <= now.hour < ALERT_NIGHT_END
+    return now.hour >= ALERT_NIGHT_START or now.hour < ALERT_NIGHT_END
+
+def new_alert_state(fired=()):
+    return {
+        'sample': {},
+        'rules': {
+            r['name']: {'holds': r['name'] in fired, 'streak': 0, 'fired': r['name'] in fired}
+            for r in ALERT_RULES
+        },
+        'pending': set(),  # Rules that hold but are still debouncing or unsent
+    }
+
+def load_alert_state():
+    try:
+        with open(ALERT_STATE_PATH, 'r') as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        print(f"Error reading {ALERT_STATE_PATH}: {e}")
+        return
+    for vin, fired in saved.items():
+        alert_states[vin] = new_alert_state(set(fired))
+
+def save_alert_state():
+    saved = {
+        vin: sorted(name for name, rule_state in state['rules'].items() if rule_state['fired'])
+        for vin, state in alert_states.items()
+    }
+    try:
+        tmp_path = ALERT_STATE_PATH + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(saved, f)
+        os.replace(tmp_path, ALERT_STATE_PATH)
+    except Exception as e:
+        print(f"Error writing {ALERT_STATE_PATH}: {e}")
+
+def evaluate_alerts(vin, label, sample):
+    # Returns (rule name, message) pairs that are due with this sample. A rule
+    # only counts as fired once confirm_alert() is called after a successful
+    # send; until then it is offered again on every sample.
+    if vin not in alert_states:
+        alert_states[vin] = new_alert_state()
+    state = alert_states[vin]
+    last = state['sample']
+    to_check = {}
+    for field, value in sample.items():
+        if field not in last or last[field] != value:
+            for rule in ALERT_RULES_BY_FIELD.get(field, ()):
+                to_check[rule['name']] = rule
+    state['sample'] = sample
+
+    cleared = False
+    for name, rule in to_check.items():
+        rule_state = state['rules'][name]
+        if rule_state['fired']:
+            clear = rule.get('clear')
+            rule_state['holds'] = not clear(sample) if clear else rule['check'](sample)
+        else:
+            rule_state['holds'] = rule['check'](sample)
+        if not rule_state['holds']:
+            cleared = cleared or rule_state['fired']
+            rule_state['streak'] = 0
+            rule_state['fired'] = False
+            state['pending'].discard(name)
+        elif not rule_state['fired']:
+            state['pending'].add(name)
+    if cleared:
+        save_alert_state()
+
+    due = []
+    if state['pending']:
+        for rule in ALERT_RULES:
+            if rule['name'] not in state['pending']:
+                continue
+            rule_state = state['rules'][rule['name']]
+            rule_state['streak'] += 1
+            if rule_state['streak'] >= rule['debounce']:
+                due.append((rule['name'], rule['message'].format(label=label, **sample)))
+    return due
+
+def confirm_alert(vin, name):
+    # Marks an alert as delivered so it stays quiet until its condition clears
+    state = alert_states[vin]
+    state['rules'][name]['fired'] = True
+    state['pending'].discard(name)
+    save_alert_state()
+
 async def track_vehicle():
     with teslapy.Tesla(TESLA_EMAIL, cache_file=TESLA_TOKEN_CACHE) as tesla:
         if not tesla.authorized:
@@ -70,6 +251,7 @@ async def track_vehicle():
 
         vehicles = tesla.vehicle_list()
         sheet = init_sheet()
+        load_alert_state()
 
         car_labels = [os.getenv("CAR_LABEL_1"), os.getenv("CAR_LABEL_2")]  # Updated names for vehicles
 
@@ -183,6 +365,28 @@ async def track_vehicle():
                     except Exception as e:
                         print(f"Error writing latest_status.json: {e}")
 
+                    # --- Alert rules ---
+                    try:
+                        sample = {
+                            'locked': locked,
+                            'sentry_mode': sentry_mode,
+                            'battery': battery,
+                            'shift_state': data['drive_state'].get('shift_state'),
+                            'doors': doors,
+                            'windows': windows,
+                            'night': is_night(datetime.now()),
+                        }
+                        for k in TPMS_FIELDS:
+                            sample[k] = data['vehicle_state'].get(k)
+                        for name, message in evaluate_alerts(vin, label, sample):
+                            if send_telegram_message(message):
+                                confirm_alert(vin, name)
+                                print(f"Alert sent for {label}: {message}")
+                            else:
+                                print(f"Alert for {label} not sent, will retry next sample: {message}")
+                    except Exception as e:
+                        print(f"Error evaluating alerts for {label}: {e}")
+
                     # --- Trip tracking logic ---
                     if vin not in vehicle_states:
                         vehicle_states[vin] = {